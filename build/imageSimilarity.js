@@ -9,24 +9,65 @@
  * @fileoverview
  *
  * A node script that uses the Jimp and ssim modules to compute if two images
- * are different enough to warrant updating.
+ * are different enough to warrant updating.  Run with two image paths to
+ * compare them, or with --server to compare pairs of paths read from stdin.
  */
 
 const Jimp = require('jimp');
+const readline = require('readline');
 const {ssim} = require('ssim.js');
 
 /**
- * Compare two images and output the similarity between 0 and 1.  Uses the same
+ * Compare two images and get the similarity between 0 and 1.  Uses the same
  * comparisons done in the tests through Karma.
  *
  * @param {string} oldPath
  * @param {string} newPath
+ * @return {!Promise.<number>}
  */
-async function main(oldPath, newPath) {
+async function compare(oldPath, newPath) {
   const oldScreenshot = await Jimp.read(oldPath);
   const newScreenshot = await Jimp.read(newPath);
   const ssimResult = ssim(oldScreenshot.bitmap, newScreenshot.bitmap);
-  console.log(ssimResult.mssim);  // A score between 0 and 1.
+  return ssimResult.mssim;  // A score between 0 and 1.
 }
 
-main(process.argv[2], process.argv[3]);
+/**
+ * Compare two images and output the similarity.
+ *
+ * @param {string} oldPath
+ * @param {string} newPath
+ */
+async function main(oldPath, newPath) {
+  console.log(await compare(oldPath, newPath));
+}
+
+/**
+ * Read pairs of image paths from stdin, one tab-separated pair per line, and
+ * output the similarity of each pair on a line of its own.  This lets one node
+ * process compare many images without paying for startup every time.
+ *
+ * If a pair can't be compared, the output for it is "error", and the details
+ * go to stderr.  Pairs are answered in the order they arrive.
+ */
+function server() {
+  const lines = readline.createInterface({input: process.stdin});
+  let previous = Promise.resolve();
+  lines.on('line', (line) => {
+    previous = previous.then(async () => {
+      const [oldPath, newPath] = line.split('\t');
+      try {
+        console.log(await compare(oldPath, newPath));
+      } catch (error) {
+        console.error(error);
+        console.log('error');
+      }
+    });
+  });
+}
+
+if (process.argv[2] == '--server') {
+  server();
+} else {
+  main(process.argv[2], process.argv[3]);
+}
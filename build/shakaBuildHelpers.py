@@ -23,6 +23,7 @@ This uses two environment variables to help with debugging the scripts:
 from __future__ import print_function
 
 import errno
+import hashlib
 import json
 import logging
 import os
@@ -30,7 +31,6 @@ import platform
 import re
 import subprocess
 import sys
-import time
 
 import subprocessWindowsPatch
 
@@ -41,51 +41,73 @@ if sys.version_info[0] == 3:
   unicode = str
 
 
-def _node_modules_last_update_path():
-  return os.path.join(get_source_base(), 'node_modules', '.last_update')
+# Set once the node modules are known to be up to date, so that scripts which
+# call into several others (like test.py calling gendeps and build) only check
+# once.
+_node_modules_up_to_date = False
 
 
-def _modules_need_update():
+def _node_modules_stamp_path():
+  return os.path.join(get_source_base(), 'node_modules', '.install_stamp')
+
+
+def _node_modules_key():
+  """Returns a hash of the package files the node modules are installed from."""
+  key = hashlib.sha256()
+  for name in ['package.json', 'package-lock.json']:
+    try:
+      with open(os.path.join(get_source_base(), name), 'rb') as f:
+        key.update(f.read())
+    except IOError:
+      # There is no lock file in the published NPM package.
+      pass
+  return key.hexdigest()
+
+
+def _modules_need_update(key):
   try:
-    last_update = os.path.getmtime(_node_modules_last_update_path())
-    if last_update > time.time():
-      # Update time in the future!  Something is wrong, so update.
-      return True
-
-    package_json_path = os.path.join(get_source_base(), 'package.json')
-    last_json_change = os.path.getmtime(package_json_path)
-    if last_json_change >= last_update:
-      # The json file has changed, so update.
-      return True
-  except:
+    with open(_node_modules_stamp_path(), 'r') as f:
+      # If the package files have changed since the last update, update.
+      return f.read() != key
+  except IOError:
     # No such file, so we should update.
     return True
 
-  return False
-
 def get_source_base():
   """Returns the absolute path to the source code base."""
   return os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 
 
+# The name of the OS, looked up on first use by get_system_name.
+_system_name = None
+
+
+def get_system_name():
+  """Returns the name of the OS, which can't change while we run."""
+  global _system_name
+  if _system_name is None:
+    _system_name = platform.uname()[0]
+  return _system_name
+
+
 def is_linux():
   """Determines if the system is Linux."""
-  return platform.uname()[0] == 'Linux'
+  return get_system_name() == 'Linux'
 
 
 def is_darwin():
   """Determines if the system is a Mac."""
-  return platform.uname()[0] == 'Darwin'
+  return get_system_name() == 'Darwin'
 
 
 def is_windows():
   """Determines if the system is native Windows (i.e. not Cygwin)."""
-  return platform.uname()[0] == 'Windows'
+  return get_system_name() == 'Windows'
 
 
 def is_cygwin():
   """Determines if the system is Cygwin (i.e. not native Windows)."""
-  return 'CYGWIN' in platform.uname()[0]
+  return 'CYGWIN' in get_system_name()
 
 
 def quote_argument(arg):
@@ -122,18 +144,18 @@ def open_file(*args, **kwargs):
     return open(encoding='utf8', *args, **kwargs)
 
 
-def execute_subprocess(args, **kwargs):
-  """Executes the given command using subprocess.
+def _execute(start, args):
+  """Checks and prints the given command, then starts it with |start|.
 
   If PRINT_ARGUMENTS environment variable is set, this will first print the
   arguments.
 
   Args:
-    args: A list of strings for the subprocess to run.
-    kwargs: Extra keyword arguments to pass to Popen.
+    start: A function which takes |args| and starts the command.
+    args: A list of strings for the command to run.
 
   Returns:
-    The same value as subprocess.Popen.
+    The value returned by |start|.
   """
   # Windows can't run scripts directly, even if executable.  We need to
   # explicitly run the interpreter.
@@ -145,7 +167,7 @@ def execute_subprocess(args, **kwargs):
   if os.environ.get('PRINT_ARGUMENTS'):
     logging.info(' '.join([quote_argument(x) for x in args]))
   try:
-    return subprocess.Popen(args, **kwargs)
+    return start(args)
   except OSError as e:
     if e.errno == errno.ENOENT:
       logging.error('*** A required dependency is missing: %s', args[0])
@@ -154,6 +176,45 @@ def execute_subprocess(args, **kwargs):
     raise
 
 
+def execute_subprocess(args, **kwargs):
+  """Executes the given command using subprocess.
+
+  If PRINT_ARGUMENTS environment variable is set, this will first print the
+  arguments.
+
+  Args:
+    args: A list of strings for the subprocess to run.
+    kwargs: Extra keyword arguments to pass to Popen.
+
+  Returns:
+    The same value as subprocess.Popen.
+  """
+  return _execute(lambda args: subprocess.Popen(args, **kwargs), args)
+
+
+def _exec(args):
+  # Anything still buffered would be lost when the process is replaced.
+  sys.stdout.flush()
+  sys.stderr.flush()
+  os.execvp(args[0], args)
+
+
+def execute_in_place(args):
+  """Replaces the current process with the given command.
+
+  This does not return.  The exit code of the command becomes the exit code of
+  this process.  This is not supported on native Windows, which can only start
+  a new process.
+
+  If PRINT_ARGUMENTS environment variable is set, this will first print the
+  arguments.
+
+  Args:
+    args: A list of strings for the command to run.
+  """
+  _execute(_exec, args)
+
+
 def execute_get_code(args):
   """Calls execute_subprocess and gets return code."""
   obj = execute_subprocess(args)
@@ -315,8 +376,14 @@ class InDir(object):
 
 def update_node_modules():
   """Updates the node modules using 'npm', if they have not already been
-     updated recently enough."""
-  if not _modules_need_update():
+     updated since package.json or package-lock.json last changed."""
+  global _node_modules_up_to_date
+  if _node_modules_up_to_date:
+    return True
+
+  key = _node_modules_key()
+  if not _modules_need_update(key):
+    _node_modules_up_to_date = True
     return True
 
   base = cygwin_safe_path(get_source_base())
@@ -329,8 +396,10 @@ def update_node_modules():
     # packages installed.
     execute_get_output(['npm', 'ci'])
 
-  # Update the timestamp of the file that tracks when we last updated.
-  open(_node_modules_last_update_path(), 'wb').close()
+  # Record which package files we last updated from.
+  with open(_node_modules_stamp_path(), 'w') as f:
+    f.write(key)
+  _node_modules_up_to_date = True
   return True
 
 
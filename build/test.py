@@ -17,11 +17,16 @@
 """Runs unit and integrations tests on the library."""
 
 import argparse
+import collections
 import json
 import logging
+import multiprocessing
 import os
-import platform
 import re
+import shutil
+import subprocess
+import sys
+import tempfile
 
 import build
 import gendeps
@@ -34,6 +39,47 @@ import shakaBuildHelpers
 LOCAL_CAPTURE_TIMEOUT = 1 * 60 * 1000  # 1m in ms
 SELENIUM_CAPTURE_TIMEOUT = 10 * 60 * 1000  # 10m in ms
 
+# The port Karma listens on when --port is not given.  With
+# --parallel-browsers or --shards, each additional Karma server counts up from
+# here.
+KARMA_DEFAULT_PORT = 9876
+
+# With --use-xvfb, when several Karma servers run at once, each gets its own
+# free X display, searching up from here as xvfb-run --auto-servernum does.
+# --auto-servernum doesn't reserve the display it picks, so servers started
+# together could pick the same one.
+XVFB_BASE_SERVER_NUM = 99
+
+# Where --shards records how long each top-level test suite takes to run.
+TEST_TIMES_PATH = os.path.join(
+    shakaBuildHelpers.get_source_base(), '.build-cache', 'test-times.json')
+
+# The settings which change which tests run.  Test times are recorded
+# separately for each combination of these.
+TEST_SET_SETTINGS = ['drm', 'external', 'quarantined', 'quick']
+
+# The test filter used for `--filter offline`.
+OFFLINE_FILTER = (
+    '(Offline|Storage|DownloadProgress|ManifestConverter|Indexeddb)')
+
+# A node script which exits with an error if its argument is not a valid
+# RegExp, in the same way test/test/boot.js uses the --filter argument.
+JS_REGEXP_CHECK = (
+    'try { new RegExp(process.argv[1]); } '
+    'catch (e) { console.log(e.message); process.exit(1); }')
+
+# The browsers which can be tested by default, keyed by system name.  All
+# Cygwin versions share the 'CYGWIN' entry.
+DEFAULT_BROWSERS = {
+  # For MP4 support on Linux Firefox, install gstreamer1.0-libav.
+  # Opera on Linux only supports MP4 for Ubuntu 15.04+, so it is not in the
+  # default list of browsers for Linux at this time.
+  'Linux': ['Chrome','Edge','Firefox'],
+  'Darwin': ['Chrome','Edge','Firefox','Safari'],
+  'Windows': ['Chrome','Edge','Firefox'],
+  'CYGWIN': ['Chrome','Edge','Firefox'],
+}
+
 
 class _HandleMixedListsAction(argparse.Action):
   '''Action to handle comma-separated and space-separated lists.
@@ -45,13 +91,18 @@ class _HandleMixedListsAction(argparse.Action):
 
      This action will expand the comma-separated lists and merge then with
      the space separated lists so you will get |['a', 'b', 'c', 'd']|.
+     Repeated values are dropped, keeping the first occurrence.
   '''
 
   def __call__(self, parser, namespace, new_values, option_string=None):
-    merged = getattr(namespace, self.dest) or []
+    merged = getattr(namespace, self.dest)
+    if merged is None:
+      merged = []
+      setattr(namespace, self.dest, merged)
     for value in new_values:
-      merged += value.split(',')
-    setattr(namespace, self.dest, merged)
+      merged.extend(value.split(','))
+    # Drop duplicates in place, keeping the order.
+    merged[:] = collections.OrderedDict.fromkeys(merged)
 
 
 class _HandleKeyValuePairs(argparse.Action):
@@ -84,6 +135,25 @@ def _KeyValueValidator(argument):
         'Received %s but expecting format of key=value' % argument
       ) 
 
+def _RegExpValidator(argument):
+  '''To validate the option is a JavaScript regular expression.
+
+    A malformed filter would otherwise only be reported by the browser, after
+    Karma has already started and loaded every test.  The filter is checked by
+    node, since Python regular expressions have a different syntax.
+  '''
+
+  try:
+    shakaBuildHelpers.execute_get_output([
+      'node', '-e', JS_REGEXP_CHECK, argument,
+    ])
+  except subprocess.CalledProcessError as e:
+    raise argparse.ArgumentTypeError(
+      'Received %s but expecting a regular expression: %s' % (
+          argument, e.output.decode('utf8').strip())
+    )
+  return argument
+
 def _IntGreaterThanZero(x):
   i = int(x)
   if i <= 0:
@@ -91,22 +161,78 @@ def _IntGreaterThanZero(x):
   return i
 
 
+def _ShardCount(x):
+  # Leave two cores free for the rest of the system.
+  if x == 'auto':
+    return max(1, multiprocessing.cpu_count() - 2)
+  return _IntGreaterThanZero(x)
+
+
 def _GetDefaultBrowsers():
   """Use the platform name to get which browsers can be tested."""
 
-  if shakaBuildHelpers.is_linux():
-    # For MP4 support on Linux Firefox, install gstreamer1.0-libav.
-    # Opera on Linux only supports MP4 for Ubuntu 15.04+, so it is not in the
-    # default list of browsers for Linux at this time.
-    return ['Chrome','Edge','Firefox']
+  system = shakaBuildHelpers.get_system_name()
+  if shakaBuildHelpers.is_cygwin():
+    system = 'CYGWIN'
 
-  if shakaBuildHelpers.is_darwin():
-    return ['Chrome','Edge','Firefox','Safari']
+  if system in DEFAULT_BROWSERS:
+    return list(DEFAULT_BROWSERS[system])
 
-  if shakaBuildHelpers.is_windows() or shakaBuildHelpers.is_cygwin():
-    return ['Chrome','Edge','Firefox']
+  raise Error('Unrecognized system: %s' % shakaBuildHelpers.get_system_name())
 
-  raise Error('Unrecognized system: %s' % platform.uname()[0])
+
+def _LoadTestTimes():
+  """Load the recorded test times, keyed by test set and then by suite."""
+  try:
+    with shakaBuildHelpers.open_file(TEST_TIMES_PATH, 'r') as f:
+      return json.load(f)
+  except (IOError, ValueError):
+    return {}
+
+
+def _PackSuites(suite_times, shard_count):
+  """Assign suites to shards so that the shards take about as long to run.
+
+     Suites are placed longest first, each on the shard with the least total
+     time so far.  Returns a list of suite names for each shard.
+  """
+  shards = [[] for _ in range(shard_count)]
+  loads = [0] * shard_count
+  for suite in sorted(suite_times, key=lambda s: (-suite_times[s], s)):
+    i = loads.index(min(loads))
+    shards[i].append(suite)
+    loads[i] += suite_times[suite]
+  return shards
+
+
+def _GetFreeXvfbServerNums(count):
+  """Find |count| X displays which are not in use.
+
+     Like xvfb-run --auto-servernum, a display is in use if it has a lock file.
+  """
+  server_nums = []
+  server_num = XVFB_BASE_SERVER_NUM
+  while len(server_nums) < count:
+    if not os.path.exists('/tmp/.X%d-lock' % server_num):
+      server_nums.append(server_num)
+    server_num += 1
+  return server_nums
+
+
+def _ExecuteInParallel(commands):
+  """Run the commands side-by-side and return their exit codes in order.
+
+     Two cores are left free for the rest of the system.
+     If there are more commands than remaining cores, the extra commands wait
+     for earlier ones to finish.
+  """
+  # Imported here so that the rest of this script still runs on Python 2,
+  # which has no concurrent.futures.
+  import concurrent.futures
+
+  max_workers = min(len(commands), max(1, multiprocessing.cpu_count() - 2))
+  with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+    return list(executor.map(shakaBuildHelpers.execute_get_code, commands))
 
 
 # TODO(joeyparrish): When internal tools using this Launcher system are removed,
@@ -131,20 +257,32 @@ class Launcher:
   def __init__(self, description):
     self.karma_config = {}
     self.parsed_args = None
-    self.parser = argparse.ArgumentParser(
-        description=description,
+    self._description = description
+    self._parser = None
+
+  @property
+  def parser(self):
+    """The argument parser, built on first use."""
+    if self._parser is None:
+      self._parser = self._BuildParser()
+    return self._parser
+
+  def _BuildParser(self):
+    """Create the parser and declare all the arguments it accepts."""
+    parser = argparse.ArgumentParser(
+        description=self._description,
         formatter_class=argparse.RawDescriptionHelpFormatter)
 
-    running_commands = self.parser.add_argument_group(
+    running_commands = parser.add_argument_group(
         'Running',
         'These commands affect how tests are run.')
-    logging_commands = self.parser.add_argument_group(
+    logging_commands = parser.add_argument_group(
         'Logging',
         'These commands affect what gets logged and how the logs will appear.')
-    networking_commands = self.parser.add_argument_group(
+    networking_commands = parser.add_argument_group(
         'Networking',
         'These commands affect how Karma works over a network.')
-    pre_launch_commands = self.parser.add_argument_group(
+    pre_launch_commands = parser.add_argument_group(
         'Pre-Launch',
         'These commands are handled before the tests start running.')
 
@@ -161,6 +299,22 @@ class Launcher:
         help='Browsers to skip as a comma-separated or space-separated list.',
         action=_HandleMixedListsAction,
         nargs='+')
+    running_commands.add_argument(
+        '--parallel-browsers',
+        help='Run each browser in its own Karma server, all at the same '
+             'time, instead of running every browser from a single server. '
+             'Requires Python 3.',
+        action='store_true')
+    running_commands.add_argument(
+        '--shards',
+        help='Split the tests for each browser across this many Karma '
+             'servers running at the same time, or "auto" for two fewer than '
+             'the number of cores.  Suites are balanced using the times '
+             'recorded by earlier runs with --shards.  Until there are times '
+             'to use, the test files are dealt out evenly.  Requires Python 3. '
+             '(default %(default)s)',
+        type=_ShardCount,
+        default=1)
     running_commands.add_argument(
         '--no-browsers',
         help='Instead of Karma starting browsers, Karma will wait for a '
@@ -181,7 +335,7 @@ class Launcher:
         '--filter',
         help='Specify a regular expression to limit which tests run. Or, use'
              '`--filter offline` to filter to all offline playback tests.',
-        type=str,
+        type=_RegExpValidator,
         dest='filter')
     running_commands.add_argument(
         '--use-xvfb',
@@ -218,6 +372,11 @@ class Launcher:
         type=_IntGreaterThanZero,
         default=1,
         dest='runs')
+    running_commands.add_argument(
+        '--fail-fast',
+        help='With --runs, stop after the first run that fails instead of '
+             'completing the remaining runs.',
+        action='store_true')
     running_commands.add_argument(
         '--uncompiled',
         help='Use the uncompiled source code when running the tests. This can '
@@ -366,6 +525,7 @@ class Launcher:
         help='Print the command passed to Karma before passing it to Karma.',
         action='store_true')
 
+    return parser
 
   def ParseArguments(self, args):
     """Parse the given arguments.
@@ -419,7 +579,7 @@ class Launcher:
     filterValue = getattr(self.parsed_args, 'filter', None)
     if filterValue is not None:
       if str(filterValue) == 'offline':
-        self.karma_config['filter'] = '(Offline|Storage|DownloadProgress|ManifestConverter|Indexeddb)'
+        self.karma_config['filter'] = OFFLINE_FILTER
       else:
         self.karma_config['filter'] = filterValue
 
@@ -440,26 +600,177 @@ class Launcher:
     assert(default_browsers and len(default_browsers))
     self.karma_config['default_browsers'] = default_browsers
 
-  def RunCommand(self, karma_conf):
+  def _GetBrowserList(self):
+    """Get the browsers Karma will launch, resolved as karma.conf.js does.
+
+       Returns an empty list if the browsers can't be known ahead of time, such
+       as when they come from a Selenium grid config or are connected by hand.
+    """
+    browsers = self.parsed_args.browsers
+    if self.parsed_args.no_browsers or browsers == ['help']:
+      return []
+    if not browsers:
+      if self.parsed_args.grid_config:
+        return []
+      browsers = self.karma_config.get('default_browsers', [])
+
+    excluded = frozenset(self.parsed_args.exclude_browsers or ())
+    return sorted(set(browsers) - excluded)
+
+  def _CanShard(self):
+    """Returns True if --shards was given and can apply to this run."""
+    if self.parsed_args.shards == 1:
+      return False
+    # Shards which end up with no tests to run would fail, so don't split the
+    # tests when only some or unknown tests will run.
+    if (self.parsed_args.no_browsers or self.parsed_args.filter or
+        self.parsed_args.test_custom_asset):
+      logging.warning('Ignoring --shards with --no-browsers, --filter, or '
+                      '--test-custom-asset')
+      return False
+    # Each server would replace the coverage report written by the others.
+    if self.parsed_args.html_coverage_report:
+      logging.warning('Ignoring --shards with --html-coverage-report')
+      return False
+    return True
+
+  def _CanRunBrowsersInParallel(self):
+    """Returns True if --parallel-browsers was given and can apply to this run.
+
+       Each server would replace the coverage report written by the others, so
+       browsers can't run in parallel with --html-coverage-report.
+    """
+    return (self.parsed_args.parallel_browsers and
+            not self.parsed_args.html_coverage_report)
+
+  def _GetTestSetKey(self):
+    """Get the key under which test times are recorded for this run."""
+    return ','.join('%s=%s' % (name, bool(self.karma_config.get(name)))
+                    for name in TEST_SET_SETTINGS)
+
+  def _GetShards(self):
+    """Decide how to split the tests for each browser.
+
+       Returns a list of settings to add for each shard.  Every shard runs the
+       suites packed into it, and the first also runs any suite with no
+       recorded time, so that new suites are never skipped.
+    """
+    shard_count = self.parsed_args.shards
+    suite_times = _LoadTestTimes().get(self._GetTestSetKey(), {})
+    if len(suite_times) < shard_count:
+      # Without enough times to balance the suites, deal out the test files
+      # round-robin instead.
+      logging.info('Not enough test times recorded yet, so the test files '
+                   'will be split evenly.')
+      return [{'shard_index': i, 'shard_count': shard_count}
+              for i in range(shard_count)]
+
+    known_suites = sorted(suite_times)
+    return [{
+        'known_suites': known_suites,
+        'shard_suites': suites,
+        'run_unknown_suites': i == 0,
+    } for i, suites in enumerate(_PackSuites(suite_times, shard_count))]
+
+  def _GetKarmaSettings(self, temp_dir, record_times):
+    """Split |self.karma_config| into the settings for each Karma server.
+
+       With --parallel-browsers, each browser gets servers of its own, so the
+       browsers run concurrently.  With --shards, the tests for each browser
+       are split across several servers.  Each server gets its own port.
+
+       If |record_times| is true, each server writes its test times to a file
+       in |temp_dir|.
+    """
+    browsers = self._GetBrowserList()
+    if self._CanRunBrowsersInParallel() and len(browsers) > 1:
+      browser_groups = [[browser] for browser in browsers]
+    else:
+      # One server runs every browser.
+      browser_groups = [None]
+    # Sharding is only possible when test times are being recorded.
+    shards = self._GetShards() if record_times else [{}]
+
+    server_count = len(browser_groups) * len(shards)
+    base_port = self.parsed_args.port or KARMA_DEFAULT_PORT
+    all_settings = []
+    for browser_group in browser_groups:
+      for shard in shards:
+        settings = dict(self.karma_config)
+        settings.update(shard)
+        if browser_group:
+          settings['browsers'] = browser_group
+          settings.pop('exclude_browsers', None)
+        if server_count > 1:
+          settings['port'] = base_port + len(all_settings)
+        if record_times:
+          settings['test_times_output'] = os.path.join(
+              temp_dir, 'times-%d.json' % len(all_settings))
+        all_settings.append(settings)
+    return all_settings
+
+  def _RecordTestTimes(self, all_settings):
+    """Record the test times written by the Karma servers.
+
+       The times from this run replace any recorded before for the same test
+       set, so that suites which were renamed or removed are forgotten.  If any
+       server failed to write its times, nothing is recorded.
+    """
+    paths = [settings['test_times_output'] for settings in all_settings]
+    if not all(os.path.exists(path) for path in paths):
+      # A server failed before it finished running tests, so the times from
+      # this run are incomplete.  Remove the rest, so that they aren't mixed
+      # up with the times from a later run.
+      logging.info('Not recording test times, since some are missing.')
+      for path in paths:
+        if os.path.exists(path):
+          os.remove(path)
+      return
+
+    run_times = {}
+    for path in paths:
+      with shakaBuildHelpers.open_file(path, 'r') as f:
+        server_times = json.load(f)
+      os.remove(path)
+      # The same suite may have run on several browsers.  Keep the slowest.
+      for suite, time in server_times.items():
+        run_times[suite] = max(time, run_times.get(suite, 0))
+
+    if not run_times:
+      return
+
+    all_times = _LoadTestTimes()
+    all_times[self._GetTestSetKey()] = run_times
+    try:
+      os.mkdir(os.path.dirname(TEST_TIMES_PATH))
+    except OSError:
+      pass
+    with shakaBuildHelpers.open_file(TEST_TIMES_PATH, 'w') as f:
+      json.dump(all_times, f, indent=2, sort_keys=True)
+
+  def RunCommand(self, karma_conf, replace_process=False):
     """Build a command and send it to Karma for execution.
 
        Uses |self.parsed_args| and |self.karma_config| to build and run a Karma
        command.
+
+       If |replace_process| is true and Karma only needs to run once, this
+       process is replaced with Karma, and this method does not return.  Only
+       pass it when nothing else needs to run after the tests.
     """
     if self.parsed_args.use_xvfb and not shakaBuildHelpers.is_linux():
       logging.error('xvfb can only be used on Linux')
       return 1
 
+    if ((self.parsed_args.parallel_browsers or self.parsed_args.shards > 1) and
+        sys.version_info[0] == 2):
+      logging.error('--parallel-browsers and --shards require Python 3')
+      return 1
+
     if not shakaBuildHelpers.update_node_modules():
       logging.error('Failed to update node modules')
       return 1
 
-    karma = shakaBuildHelpers.get_node_binary('karma')
-    cmd = ['xvfb-run', '--auto-servernum'] if self.parsed_args.use_xvfb else []
-    cmd += karma + ['start']
-    cmd += [karma_conf] if karma_conf else []
-    cmd += ['--settings', json.dumps(self.karma_config)]
-
     # There is no need to print a status here as the gendep and build
     # calls will print their own status updates.
     if self.parsed_args.build:
@@ -471,36 +782,139 @@ class Launcher:
         logging.error('Failed to build project')
         return 1
 
-    # Before Running the command, print the command.
+    record_times = self._CanShard()
+    if (self.parsed_args.parallel_browsers and
+        not self._CanRunBrowsersInParallel()):
+      logging.warning('Ignoring --parallel-browsers with '
+                      '--html-coverage-report')
+
+    # For a single run on a single Karma server, there is nothing left for us
+    # to do once Karma starts, so let Karma take over this process.  Windows
+    # can't replace a process, so it always waits on Karma instead.
+    if (replace_process and self.parsed_args.runs == 1 and not record_times and
+        not shakaBuildHelpers.is_windows()):
+      all_settings = self._GetKarmaSettings(None, record_times)
+      if len(all_settings) == 1:
+        self._ExecKarma(karma_conf, all_settings[0])
+
+    # The settings for each Karma server go in a temporary folder, along with
+    # the test times the servers record with --shards.
+    temp_dir = tempfile.mkdtemp()
+    try:
+      return self._RunKarma(karma_conf, temp_dir, record_times)
+    finally:
+      shutil.rmtree(temp_dir, ignore_errors=True)
+
+  def _GetKarmaCommand(self, karma_conf, xvfb_server_num=None):
+    """Get the command to start Karma, without any settings.
+
+       With --use-xvfb, Karma runs on X display |xvfb_server_num|, or on any
+       free display if it is None.
+    """
+    karma = shakaBuildHelpers.get_node_binary('karma')
+    cmd = []
+    if self.parsed_args.use_xvfb:
+      if xvfb_server_num is None:
+        cmd = ['xvfb-run', '--auto-servernum']
+      else:
+        cmd = ['xvfb-run', '--server-num=%d' % xvfb_server_num]
+    cmd += karma + ['start']
+    cmd += [karma_conf] if karma_conf else []
+    return cmd
+
+  def _ExecKarma(self, karma_conf, settings):
+    """Replace this process with a single run of Karma.  Does not return."""
+    # Once this process is gone, there is nothing left to clean up the
+    # settings file, so Karma deletes it when it exits.
+    settings = dict(settings, delete_settings_file=True)
+    fd, settings_path = tempfile.mkstemp(suffix='.json')
+    with os.fdopen(fd, 'w') as f:
+      json.dump(settings, f)
+
+    cmd = self._GetKarmaCommand(karma_conf) + [
+      '--settings-file', shakaBuildHelpers.cygwin_safe_path(settings_path),
+    ]
+
+    # Before Running the command, print the command.  The settings file will
+    # be gone by the time anyone reads this, so print the settings too.
     if self.parsed_args.print_command:
       logging.info('Karma Run Command')
       logging.info('%s', cmd)
+      logging.info('%s', json.dumps(settings))
+
+    logging.info('Running test...')
+    shakaBuildHelpers.execute_in_place(cmd)
+
+  def _RunKarma(self, karma_conf, temp_dir, record_times):
+    """Run Karma as many times as requested and summarize the results."""
+    # Pass the settings in a file rather than on the command line, where they
+    # could exceed the length limit for arguments.  Each file is written once
+    # and reused by every run.
+    all_settings = self._GetKarmaSettings(temp_dir, record_times)
+    xvfb_server_nums = [None] * len(all_settings)
+    if self.parsed_args.use_xvfb and len(all_settings) > 1:
+      xvfb_server_nums = _GetFreeXvfbServerNums(len(all_settings))
+    commands = []
+    for i, settings in enumerate(all_settings):
+      settings_path = os.path.join(temp_dir, 'settings-%d.json' % i)
+      with shakaBuildHelpers.open_file(settings_path, 'w') as f:
+        json.dump(settings, f)
+      cmd = self._GetKarmaCommand(karma_conf, xvfb_server_nums[i])
+      commands.append(cmd + [
+        '--settings-file', shakaBuildHelpers.cygwin_safe_path(settings_path),
+      ])
+
+    # Before Running the command, print the command.  The settings files will
+    # be gone by the time anyone reads this, so print the settings too.
+    if self.parsed_args.print_command:
+      logging.info('Karma Run Command')
+      for command, settings in zip(commands, all_settings):
+        logging.info('%s', command)
+        logging.info('%s', json.dumps(settings))
 
     # Run the command.
     results = []
+    failed = 0
     for run in range(self.parsed_args.runs):
       logging.info('Running test (%d / %d, %d failed so far)...',
-          run + 1, self.parsed_args.runs, len(results) - results.count(0))
-      results.append(shakaBuildHelpers.execute_get_code(cmd))
+          run + 1, self.parsed_args.runs, failed)
+      if len(commands) == 1:
+        result = shakaBuildHelpers.execute_get_code(commands[0])
+      else:
+        # A run fails if any of the servers failed.
+        codes = _ExecuteInParallel(commands)
+        result = next((code for code in codes if code != 0), 0)
+      results.append(result)
+      failed += result != 0
+
+      if record_times:
+        self._RecordTestTimes(all_settings)
+
+      if result != 0 and self.parsed_args.fail_fast:
+        logging.info('Stopping after the first failure (--fail-fast).')
+        break
 
     # Print a summary of the results.
     if self.parsed_args.runs > 1:
-      logging.info('All runs completed. %d / %d runs passed.',
-                   results.count(0),
+      logging.info('%d / %d runs completed. %d / %d runs passed.',
+                   len(results),
+                   self.parsed_args.runs,
+                   len(results) - failed,
                    len(results))
       logging.info('Results (exit code): %r', results)
     else:
       logging.info('Run complete')
       logging.info('Result (exit code): %d', results[0])
 
-    return 0 if all(result == 0 for result in results) else 1
+    return 1 if failed else 0
 
 
 def Run(args):
   launcher = Launcher('Shaka Player Test Runner Script')
   launcher.ParseArguments(args)
   launcher.ResolveBrowsers(_GetDefaultBrowsers())
-  return launcher.RunCommand(None)
+  # Nothing runs after the tests, so Karma can take over this process.
+  return launcher.RunCommand(None, replace_process=True)
 
 
 def main(args):
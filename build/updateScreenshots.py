@@ -16,12 +16,137 @@
 
 """Update the screenshots in our layout tests based on the latest run."""
 
+import hashlib
+import logging
+import multiprocessing.pool
 import os
 import shutil
+import subprocess
 
 import shakaBuildHelpers
 
 
+# Files which can sit beside the platform folders, and which we can rule out by
+# name without checking the file system.
+_SKIP_NAMES = frozenset(['README.md', 'Thumbs.db'])
+
+
+def _hash(path):
+  """Hash the contents of a file, reading it a chunk at a time."""
+  digest = hashlib.sha256()
+  with open(path, 'rb') as f:
+    for chunk in iter(lambda: f.read(1 << 20), b''):
+      digest.update(chunk)
+  return digest.digest()
+
+
+def _same_bytes(pathA, pathB):
+  """Returns True if both files have exactly the same contents."""
+  if os.path.getsize(pathA) != os.path.getsize(pathB):
+    return False
+  return _hash(pathA) == _hash(pathB)
+
+
+class SimilarityWorker(object):
+  """A long-lived node process which compares pairs of screenshots."""
+
+  def __init__(self, imageSimilarityTool):
+    self.process = shakaBuildHelpers.execute_subprocess(
+        ['node', imageSimilarityTool, '--server'],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+        universal_newlines=True, bufsize=1)
+
+  def get_similarity(self, officialPath, newPath):
+    """Returns the similarity, or None if the worker has exited.
+
+    Raises RuntimeError if the worker couldn't compare the screenshots.
+    """
+    try:
+      self.process.stdin.write(officialPath + '\t' + newPath + '\n')
+      self.process.stdin.flush()
+    except (IOError, OSError):
+      return None
+    output = self.process.stdout.readline()
+    if not output:
+      return None
+    if output.strip() == 'error':
+      # The worker has already printed the details.
+      raise RuntimeError('Failed to compare ' + newPath)
+    return float(output)
+
+  def close(self):
+    try:
+      self.process.stdin.close()
+    except (IOError, OSError):
+      pass
+    self.process.wait()
+
+
+def get_similarity(imageSimilarityTool, officialPath, newPath):
+  """Measure how similar a new screenshot is to the official one, from 0 to 1.
+
+  This starts a node process for a single comparison.
+  """
+  output = shakaBuildHelpers.execute_get_output([
+      'node',
+      imageSimilarityTool,
+      officialPath,
+      newPath,
+  ])
+  return float(output)
+
+
+def compare_screenshots(imageSimilarityTool, screenshots):
+  """Measure the similarity of each (official, new, hasOfficial) screenshot.
+
+  The png file itself can be slightly different byte-for-byte even when the
+  image is visibly the same, so this uses the same tools we use to measure
+  screenshot differences in Karma.  Files with identical bytes are skipped
+  without asking node at all.  All the other comparisons share one node
+  process, started when the first one needs it.  If that process exits early,
+  each remaining comparison gets a process of its own.
+
+  Returns a list of similarities between 0 and 1, in the same order.  The
+  similarity is None for screenshots which couldn't be compared.
+  """
+  worker = None
+  workerExited = False
+  similarities = []
+
+  for officialPath, newPath, hasOfficial in screenshots:
+    if not hasOfficial:
+      # No original?  Then everything has changed!
+      similarities.append(0)
+      continue
+
+    if _same_bytes(officialPath, newPath):
+      # Nothing changed at all, so there's no need to ask node.
+      similarities.append(1.0)
+      continue
+
+    similarity = None
+    if not workerExited:
+      if not worker:
+        worker = SimilarityWorker(imageSimilarityTool)
+      try:
+        similarity = worker.get_similarity(officialPath, newPath)
+      except RuntimeError as e:
+        logging.error('%s', e)
+        similarities.append(None)
+        continue
+      if similarity is None:
+        worker.close()
+        worker = None
+        workerExited = True
+    if similarity is None:
+      similarity = get_similarity(imageSimilarityTool, officialPath, newPath)
+    similarities.append(similarity)
+
+  if worker:
+    worker.close()
+  return similarities
+
+
 def main(args):
   base = shakaBuildHelpers.get_source_base()
 
@@ -30,55 +155,77 @@ def main(args):
   imageSimilarityTool = os.path.join(
       base, 'build', 'imageSimilarity.js');
 
+  # Find all the new screenshots first, as (official, new) paths along with
+  # whether the official version exists yet.
+  screenshots = []
+
   for platform in os.listdir(screenshotsFolder):
+    # Skip hidden files like .gitignore and non-folders.  Check the name first,
+    # since that never needs a stat call.
+    if platform.startswith('.') or platform in _SKIP_NAMES:
+      continue
+
     # This is a subfolder with actual screenshots.
     platformFolder = os.path.join(screenshotsFolder, platform)
-
     if not os.path.isdir(platformFolder):
-      # Skip hidden files like .gitignore and non-folders
       continue
 
-    for child in os.listdir(platformFolder):
+    # Only the names are needed, so listing the folder is enough to tell which
+    # official versions exist, without checking each one.
+    children = set(os.listdir(platformFolder))
+
+    for child in sorted(children):
       # If any args were specified, use them to filter.  Either the platform or
       # base of the filename must match the filter.
       if args and not platform in args and not child.split('.')[0] in args:
         continue
 
-      fullPath = os.path.join(platformFolder, child)
       # If this has the "-new" suffix, it was just written by the layout tests.
-      # Rename it to overwrite the "official" version, which is stored in
-      # git-lfs.
-      if fullPath.endswith('-new'):
-        officialPath = fullPath[:-4]
-
-        # Finally, check to see if the pixels have changed before updating it.
-        # The png file itself can be slightly different byte-for-byte even when
-        # the image is visibly the same, and the git repo history will carry
-        # every revision forever, getting larger with each change.  So we only
-        # want to update the image if the new one is _visibly_ different.  For
-        # this, we use the same tools we use to measure screenshot differences
-        # in Karma.
-        if os.path.exists(officialPath):
-          output = shakaBuildHelpers.execute_get_output([
-              'node',
-              imageSimilarityTool,
-              officialPath,
-              fullPath,
-          ])
-          similarity = float(output)
-        else:
-          # No original?  Then everything has changed!
-          similarity = 0
-
-        if similarity >= 0.95:
-          # Similar enough to pass tests, so don't update the image.  This will
-          # keep the git history from getting bigger for no reason.
-          continue
-
-        shutil.move(fullPath, officialPath)
-        print('Updated: ' + officialPath)
-
-  return 0
+      # It may replace the "official" version, which is stored in git-lfs.
+      if child.endswith('-new'):
+        fullPath = os.path.join(platformFolder, child)
+        hasOfficial = child[:-4] in children
+        screenshots.append((fullPath[:-4], fullPath, hasOfficial))
+
+  # Check to see if the pixels have changed before updating anything.  The git
+  # repo history will carry every revision forever, getting larger with each
+  # change.  So we only want to update the image if the new one is _visibly_
+  # different.  Deal the screenshots out to several node workers and run them
+  # side by side, leaving two cores free for the rest of the system.
+  workerCount = min(len(screenshots),
+                    max(1, multiprocessing.cpu_count() - 2))
+  batches = [screenshots[i::workerCount] for i in range(workerCount)]
+  similarities = {}
+  pool = multiprocessing.pool.ThreadPool(max(1, workerCount))
+  try:
+    results = pool.map(
+        lambda batch: compare_screenshots(imageSimilarityTool, batch),
+        batches)
+  finally:
+    pool.close()
+    pool.join()
+  for batch, batchSimilarities in zip(batches, results):
+    similarities.update(zip(batch, batchSimilarities))
+
+  failed = False
+  for screenshot in screenshots:
+    officialPath, fullPath, _ = screenshot
+    similarity = similarities[screenshot]
+    if similarity is None:
+      # Leave the new screenshot in place to be looked at.
+      failed = True
+      continue
+
+    if similarity >= 0.95:
+      # Similar enough to pass tests, so don't update the image.  This will
+      # keep the git history from getting bigger for no reason.
+      continue
+
+    # Rename the new screenshot to overwrite the official version.
+    shutil.move(fullPath, officialPath)
+    print('Updated: ' + officialPath)
+
+  return 1 if failed else 0
 
 
 if __name__ == '__main__':
@@ -67,11 +67,33 @@ module.exports = (config) => {
     debug: config.LOG_DEBUG,
   };
 
-  // Find the settings JSON object in the command arguments
+  // Find the settings JSON object in the command arguments.  build/test.py
+  // passes the path to a JSON file, but the object may also be given inline.
   const args = process.argv;
+  const settingsFileIndex = args.indexOf('--settings-file');
   const settingsIndex = args.indexOf('--settings');
-  const settings =
-      settingsIndex >= 0 ? JSON.parse(args[settingsIndex + 1]) : {};
+  let settings = {};
+  if (settingsFileIndex >= 0) {
+    const settingsPath = args[settingsFileIndex + 1];
+    const settingsJson = fs.readFileSync(settingsPath, 'utf8');
+    settings = JSON.parse(settingsJson);
+    if (settings.delete_settings_file) {
+      // build/test.py has handed this process over to Karma, and can't clean
+      // up after itself.
+      process.once('exit', () => {
+        try {
+          fs.unlinkSync(settingsPath);
+        } catch (error) {
+          // The file is already gone.  Don't let that change the exit code.
+        }
+      });
+    }
+    // Our plugins expect the settings JSON in the config, as Karma would have
+    // put it for an inline --settings argument.
+    config.set({settings: settingsJson});
+  } else if (settingsIndex >= 0) {
+    settings = JSON.parse(args[settingsIndex + 1]);
+  }
 
   if (settings.grid_config) {
     const gridBrowserMetadata =
@@ -192,6 +214,9 @@ module.exports = (config) => {
         'middleware:augment-reporters': [
           'factory', AugmentReportersFactory,
         ],
+
+        // An inline plugin which records how long each test suite takes.
+        'reporter:test-times': ['type', TestTimesReporter],
       },
     ],
 
@@ -356,6 +381,12 @@ module.exports = (config) => {
 
         // Overrides the default test timeout value.
         testTimeout: settings.test_timeout,
+
+        // Run only the suites assigned to this shard by build/test.py.
+        // Undefined if the tests are not split into shards.
+        knownSuites: settings.known_suites,
+        shardSuites: settings.shard_suites,
+        runUnknownSuites: settings.run_unknown_suites,
       }],
     },
 
@@ -464,6 +495,21 @@ module.exports = (config) => {
   // These are the test files that will be dynamically loaded by boot.js.
   clientArgs.testFiles = resolveGlobs(clientArgs.testFiles);
 
+  if (settings.shard_count) {
+    // build/test.py has split the test files round-robin across several
+    // servers.  Only load this server's share of the spec files.  Helpers,
+    // such as the asset list used by the external tests, are loaded by every
+    // server.
+    const isSpecFile = (file) => /_(unit|integration|external)\.js$/.test(file);
+    let specIndex = 0;
+    clientArgs.testFiles = clientArgs.testFiles.filter((file) => {
+      if (!isSpecFile(file)) {
+        return true;
+      }
+      return specIndex++ % settings.shard_count == settings.shard_index;
+    });
+  }
+
   const reporters = [];
 
   if (settings.reporters) {
@@ -498,6 +544,11 @@ module.exports = (config) => {
     reporters.push('coverage');
   }
 
+  if (settings.test_times_output) {
+    // Record test times for build/test.py to balance shards with.
+    reporters.push('test-times');
+  }
+
   config.set({reporters: reporters});
 
   if (reporters.includes('spec') && settings.spec_hide_passed) {
@@ -951,8 +1002,9 @@ function AugmentReportersFactory(reporters, settingsJson) {
       return orig(browser) + ` (${left} left)`;
     };
 
-    // If we're not filtering explicitly, log any skipped tests.
-    if (!settings.filter) {
+    // If we're not filtering explicitly, log any skipped tests.  Tests
+    // skipped because they belong to another shard are not logged.
+    if (!settings.filter && !settings.known_suites) {
       reporter.specSkipped = (browser, result) => {
         reporter.writeCommonMsg(result.fullName + ' SKIPPED\n');
       };
@@ -964,3 +1016,33 @@ function AugmentReportersFactory(reporters, settingsJson) {
   return (request, response, next) => next();
 }
 AugmentReportersFactory.$inject = ['reporter._reporters', 'config.settings'];
+
+/**
+ * A reporter which adds up how long the specs in each top-level suite took to
+ * run, and writes the totals as JSON to the path in the test_times_output
+ * setting.  build/test.py uses these times to balance suites across shards.
+ *
+ * @param {function(!Object)} baseReporterDecorator
+ * @param {string} settingsJson
+ */
+function TestTimesReporter(baseReporterDecorator, settingsJson) {
+  const settings = JSON.parse(settingsJson);
+  baseReporterDecorator(this);
+
+  // Don't write anything to the console.  That's for the other reporters.
+  this.adapters = [() => {}];
+
+  const times = {};
+
+  this.onSpecComplete = (browser, result) => {
+    const suite = result.suite[0];
+    if (suite && !result.skipped) {
+      times[suite] = (times[suite] || 0) + result.time;
+    }
+  };
+
+  this.onRunComplete = () => {
+    fs.writeFileSync(settings.test_times_output, JSON.stringify(times));
+  };
+}
+TestTimesReporter.$inject = ['baseReporterDecorator', 'config.settings'];
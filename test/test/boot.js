@@ -399,6 +399,7 @@ function configureJasmineEnvironment() {
   jasmineEnv.execute = () => {
     // Use a RegExp if --filter is set, else empty string will match all.
     const specFilterRegExp = new RegExp(getClientArg('filter') || '');
+    const isInShard = getShardFilter();
     const isBrowserSupported = shaka.Player.isBrowserSupported();
 
     /**
@@ -409,9 +410,12 @@ function configureJasmineEnvironment() {
     function specFilter(spec) {
       // If the browser is not supported, don't run the tests.
       // If the user specified a RegExp, only run the matched tests.
+      // If the tests are split into shards, only run this shard's tests.
       // Running zero tests is considered an error so the test run will fail on
       // unsupported browsers or if the filter doesn't match any specs.
-      return isBrowserSupported && specFilterRegExp.test(spec.getFullName());
+      const fullName = spec.getFullName();
+      return isBrowserSupported && specFilterRegExp.test(fullName) &&
+          isInShard(fullName);
     }
 
     // Set jasmine config.
@@ -426,6 +430,37 @@ function configureJasmineEnvironment() {
   };
 }
 
+/**
+ * Build a filter over full spec names which accepts the specs in the shard
+ * assigned to this browser by build/test.py --shards.  Accepts everything if
+ * the tests are not split into shards.
+ *
+ * @return {function(string):boolean}
+ */
+function getShardFilter() {
+  const knownSuites = getClientArg('knownSuites');
+  if (!knownSuites) {
+    return () => true;
+  }
+
+  const shardSuites = new Set(getClientArg('shardSuites'));
+  const runUnknownSuites = !!getClientArg('runUnknownSuites');
+
+  return (fullName) => {
+    // A full spec name is the names of its suites and itself, joined by
+    // spaces.  Since suite names may contain spaces, too, the spec belongs to
+    // the longest known suite name that prefixes it.
+    let suite = null;
+    for (const name of knownSuites) {
+      if (fullName.startsWith(name + ' ') &&
+          (!suite || name.length > suite.length)) {
+        suite = name;
+      }
+    }
+    return suite ? shardSuites.has(suite) : runUnknownSuites;
+  };
+}
+
 async function loadImaScript() {
   await new Promise((resolve, reject) => {
     const script = /** @type {!HTMLScriptElement} */(